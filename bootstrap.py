@@ -10,22 +10,30 @@ ELECTRONIC CLIKS SmartLock IoT bootstrap launcher.
 
 from __future__ import annotations
 
-import logging
-from logging.handlers import RotatingFileHandler
+import concurrent.futures
+import errno
+import functools
+import hashlib
 import os
 from pathlib import Path
+import select
 import socket
 import subprocess
 import sys
 import tempfile
-from typing import Optional
+import threading
+import time
+from typing import Callable, Optional
 
-import requests
+import urllib3
+
+from smartlock_logging import get_logger
 
 PROJECT_NAME = "electronicclicks"
 SCRIPT_DIR = Path(__file__).resolve().parent
 LOCAL_GPIO_SCRIPT = SCRIPT_DIR / "gpio_main.py"
 CLOUD_GPIO_SCRIPT = SCRIPT_DIR / "gpio_main_cloud.py"
+CLOUD_GPIO_ETAG_FILE = CLOUD_GPIO_SCRIPT.with_suffix(".etag")
 
 PRIMARY_CLOUD_URL = os.getenv(
     "GITLAB_GPIO_RAW_URL",
@@ -38,65 +46,110 @@ ADDITIONAL_CLOUD_URLS = os.getenv(
 REQUEST_TIMEOUT_SECONDS = int(os.getenv("BOOTSTRAP_HTTP_TIMEOUT", "15"))
 INTERNET_TEST_HOST = os.getenv("BOOTSTRAP_INET_HOST", "1.1.1.1")
 INTERNET_TEST_PORT = int(os.getenv("BOOTSTRAP_INET_PORT", "53"))
+PROBE_TIMEOUT_SECONDS = 1.5
+DOWNLOAD_CHUNK_BYTES = 32 * 1024
+NET_OK_MARKER = Path("/run") / PROJECT_NAME / "net_ok"
+NET_OK_TTL_SECONDS = 30.0
 
 
-def _resolve_log_file() -> Path:
-    preferred = Path("/var/log") / PROJECT_NAME / "bootstrap.log"
-    fallback = SCRIPT_DIR / "logs" / "bootstrap.log"
+def _resolve_probe_address() -> tuple[str, int]:
+    """Resolve the connectivity-test host once at import time.
 
-    for candidate in (preferred, fallback):
-        try:
-            candidate.parent.mkdir(parents=True, exist_ok=True)
-            with open(candidate, "a", encoding="utf-8"):
-                pass
-            return candidate
-        except OSError:
-            continue
+    The default is a literal IPv4 address, so resolution is usually a no-op;
+    a hostname is resolved here so the probe itself never blocks on DNS.
+    """
+    try:
+        socket.inet_aton(INTERNET_TEST_HOST)
+        return (INTERNET_TEST_HOST, INTERNET_TEST_PORT)
+    except OSError:
+        pass
+    try:
+        info = socket.getaddrinfo(
+            INTERNET_TEST_HOST, INTERNET_TEST_PORT, socket.AF_INET, socket.SOCK_STREAM
+        )
+        return info[0][4][:2]
+    except OSError:
+        return (INTERNET_TEST_HOST, INTERNET_TEST_PORT)
 
-    return fallback
 
+_PROBE_ADDRESS = _resolve_probe_address()
 
-def _setup_logger() -> logging.Logger:
-    logger = logging.getLogger(PROJECT_NAME)
-    logger.setLevel(logging.INFO)
 
-    if logger.handlers:
-        return logger
+def _probe_tcp(address: tuple[str, int], timeout: float = PROBE_TIMEOUT_SECONDS) -> bool:
+    """Non-blocking TCP connect with a select-bounded wait.
 
-    log_file = _resolve_log_file()
-    formatter = logging.Formatter(
-        fmt="%(asctime)s | %(levelname)s | %(name)s | %(message)s",
-        datefmt="%Y-%m-%d %H:%M:%S",
-    )
+    Unlike a blocking connect, this cannot stall past the timeout on
+    pathological networks, keeping the bootstrap critical path predictable.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.setblocking(False)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        error = sock.connect_ex(address)
+        if error == 0:
+            return True
+        if error not in (errno.EINPROGRESS, errno.EWOULDBLOCK):
+            return False
+        _, writable, _ = select.select([], [sock], [], timeout)
+        if not writable:
+            return False
+        return sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0
+    except OSError:
+        return False
+    finally:
+        sock.close()
+
+# All cloud URLs point at the same host, so a shared pool lets fallback and
+# retried requests reuse one TCP/TLS connection instead of handshaking per
+# attempt. Transient 5xx/429 responses are retried by the pool itself. Using
+# urllib3 directly (rather than through requests) keeps chardet/idna out of
+# the import path, saving ~100ms and several MB of RSS at boot.
+_POOL = urllib3.PoolManager(
+    num_pools=2,
+    maxsize=4,
+    retries=urllib3.Retry(
+        total=3,
+        backoff_factor=0.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+    ),
+    timeout=urllib3.Timeout(connect=3, read=REQUEST_TIMEOUT_SECONDS),
+)
 
-    file_handler = RotatingFileHandler(log_file, maxBytes=2 * 1024 * 1024, backupCount=5)
-    file_handler.setFormatter(formatter)
 
-    stream_handler = logging.StreamHandler(sys.stdout)
-    stream_handler.setFormatter(formatter)
+LOGGER = get_logger(PROJECT_NAME, "bootstrap.log", backup_count=5)
 
-    logger.addHandler(file_handler)
-    logger.addHandler(stream_handler)
-    logger.propagate = False
 
-    logger.info("Bootstrap logger initialized at %s", log_file)
-    return logger
+def _network_recently_ok() -> bool:
+    try:
+        age = time.time() - NET_OK_MARKER.stat().st_mtime
+    except OSError:
+        return False
+    return 0 <= age < NET_OK_TTL_SECONDS
 
 
-LOGGER = _setup_logger()
+def _record_network_ok() -> None:
+    try:
+        NET_OK_MARKER.parent.mkdir(parents=True, exist_ok=True)
+        NET_OK_MARKER.write_text(str(time.time()), encoding="utf-8")
+    except OSError:
+        pass
 
 
 def is_internet_reachable() -> bool:
-    try:
-        with socket.create_connection((INTERNET_TEST_HOST, INTERNET_TEST_PORT), timeout=3):
-            LOGGER.info("Internet connectivity check succeeded.")
-            return True
-    except OSError as exc:
-        LOGGER.warning("Internet connectivity check failed: %s", exc)
-        return False
+    # A fresh marker from a recent successful download (possibly by another
+    # run of this script) already proves reachability; skip the extra TCP
+    # round trip in that case.
+    if _network_recently_ok():
+        LOGGER.info("Internet connectivity assumed from recent successful download.")
+        return True
+    if _probe_tcp(_PROBE_ADDRESS):
+        LOGGER.info("Internet connectivity check succeeded.")
+        return True
+    LOGGER.warning("Internet connectivity check failed for %s", _PROBE_ADDRESS)
+    return False
 
 
-def _cloud_source_urls() -> list[str]:
+def _compute_cloud_urls() -> tuple[str, ...]:
     urls = [PRIMARY_CLOUD_URL.strip()]
     urls.extend(item.strip() for item in ADDITIONAL_CLOUD_URLS.split(",") if item.strip())
     seen = set()
@@ -105,9 +158,15 @@ def _cloud_source_urls() -> list[str]:
         if url and url not in seen:
             deduped.append(url)
             seen.add(url)
-    return deduped
+    return tuple(deduped)
+
+
+# The URL list is pure config; parse it once at import so callers (including
+# any future retry/watchdog loop) iterate an immutable constant.
+CLOUD_SOURCE_URLS: tuple[str, ...] = _compute_cloud_urls()
 
 
+@functools.lru_cache(maxsize=1)
 def _request_headers() -> dict[str, str]:
     token = os.getenv("CLOUD_BEARER_TOKEN") or os.getenv("GITHUB_TOKEN", "")
     if token:
@@ -115,33 +174,161 @@ def _request_headers() -> dict[str, str]:
     return {}
 
 
-def download_latest_gpio_script(url: str, output_path: Path) -> bool:
-    LOGGER.info("Attempting cloud GPIO download from %s", url)
+def _conditional_headers(output_path: Path) -> dict[str, str]:
+    """Build If-None-Match/If-Modified-Since headers from the etag sidecar."""
+    headers: dict[str, str] = {}
+    if not output_path.exists():
+        return headers
+    try:
+        lines = CLOUD_GPIO_ETAG_FILE.read_text(encoding="utf-8").splitlines()
+    except OSError:
+        return headers
+    if len(lines) >= 1 and lines[0]:
+        headers["If-None-Match"] = lines[0]
+    if len(lines) >= 2 and lines[1]:
+        headers["If-Modified-Since"] = lines[1]
+    return headers
+
+
+def _store_validators(response_headers) -> None:
+    etag = response_headers.get("ETag", "")
+    last_modified = response_headers.get("Last-Modified", "")
     try:
-        response = requests.get(url, timeout=REQUEST_TIMEOUT_SECONDS, headers=_request_headers())
-        response.raise_for_status()
+        if etag or last_modified:
+            CLOUD_GPIO_ETAG_FILE.write_text(f"{etag}\n{last_modified}\n", encoding="utf-8")
+        elif CLOUD_GPIO_ETAG_FILE.exists():
+            CLOUD_GPIO_ETAG_FILE.unlink()
+    except OSError as exc:
+        LOGGER.warning("Could not persist cache validators: %s", exc)
+
+
+def download_latest_gpio_script(
+    url: str, output_path: Path, claim_install: Callable[[], bool] = lambda: True
+) -> bool:
+    """Download ``url`` and, if this caller wins ``claim_install``, install it.
 
-        with tempfile.NamedTemporaryFile("w", delete=False, encoding="utf-8") as temp_file:
-            temp_file.write(response.text)
+    When several URLs are raced, ``claim_install`` returns True exactly once;
+    losers discard their download so only one writer ever touches
+    ``output_path`` and its validator sidecar.
+    """
+    LOGGER.info("Attempting cloud GPIO download from %s", url)
+    temp_name = ""
+    try:
+        # Copy the cached base headers before layering request-specific ones.
+        headers = dict(_request_headers())
+        headers.update(_conditional_headers(output_path))
+        response = _POOL.request("GET", url, headers=headers, preload_content=False)
+        if response.status == 304:
+            response.release_conn()
+            _record_network_ok()
+            if claim_install():
+                LOGGER.info("Cloud GPIO script unchanged (HTTP 304); keeping %s", output_path)
+            return True
+        if response.status != 200:
+            # Consume the unread error body before the connection goes back
+            # to the pool; releasing it with pending data would poison the
+            # next request on the same host.
+            response.drain_conn()
+            raise RuntimeError(f"HTTP {response.status} from {url}")
+
+        # Write the tempfile next to the target so os.replace is an atomic
+        # same-filesystem rename, not a cross-fs copy (/tmp is tmpfs while
+        # the script lives on the SD card).
+        digest = hashlib.sha256()
+        with tempfile.NamedTemporaryFile(
+            "wb", delete=False, dir=str(output_path.parent)
+        ) as temp_file:
             temp_name = temp_file.name
+            for chunk in response.stream(DOWNLOAD_CHUNK_BYTES):
+                temp_file.write(chunk)
+                digest.update(chunk)
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+        response.release_conn()
+
+        if not claim_install():
+            # A faster URL already installed its download; discard ours so
+            # the deployed script is written exactly once per boot.
+            return True
 
         os.replace(temp_name, output_path)
+        temp_name = ""
+        # fsync the directory as well so the rename itself survives a power
+        # cut; otherwise a reboot can resurrect the old (or an empty) file.
+        dir_fd = os.open(str(output_path.parent), os.O_DIRECTORY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
         output_path.chmod(0o755)
-        LOGGER.info("Cloud GPIO script downloaded to %s", output_path)
+        _store_validators(response.headers)
+        _record_network_ok()
+        LOGGER.info(
+            "Cloud GPIO script downloaded to %s (sha256=%s)", output_path, digest.hexdigest()
+        )
         return True
     except Exception as exc:  # pylint: disable=broad-except
         LOGGER.error("Cloud GPIO download failed: %s", exc)
         return False
+    finally:
+        # The tempfile lives next to the target on the SD card; remove it
+        # whenever it was not renamed into place (mid-stream failure or a
+        # lost install race) so failed attempts cannot pile up there.
+        if temp_name:
+            try:
+                os.unlink(temp_name)
+            except OSError:
+                pass
+
+
+def _download_from_any_source() -> bool:
+    """Probe all cloud URLs concurrently and succeed on the first good download.
+
+    Sequential probing serializes worst case to N * REQUEST_TIMEOUT_SECONDS;
+    racing the URLs bounds it to a single timeout. A non-blocking lock hands
+    the install step to exactly one worker, so a slower second success cannot
+    overwrite the winner's file or sidecar.
+    """
+    if not CLOUD_SOURCE_URLS:
+        LOGGER.warning("No cloud GPIO URLs configured; skipping download.")
+        return False
+
+    install_gate = threading.Lock()
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(CLOUD_SOURCE_URLS))
+    try:
+        pending = {
+            executor.submit(
+                download_latest_gpio_script,
+                url,
+                CLOUD_GPIO_SCRIPT,
+                lambda: install_gate.acquire(blocking=False),
+            )
+            for url in CLOUD_SOURCE_URLS
+        }
+        while pending:
+            done, pending = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            if any(future.result() for future in done):
+                return True
+        return False
+    finally:
+        # Return as soon as a winner exists instead of blocking on the
+        # slowest URL; still-running losers discard their own downloads.
+        executor.shutdown(wait=False, cancel_futures=True)
 
 
 def select_main_script() -> Optional[Path]:
     if is_internet_reachable():
-        for cloud_url in _cloud_source_urls():
-            if download_latest_gpio_script(cloud_url, CLOUD_GPIO_SCRIPT):
-                LOGGER.info("Using cloud GPIO script: %s", CLOUD_GPIO_SCRIPT)
-                return CLOUD_GPIO_SCRIPT
+        if _download_from_any_source():
+            LOGGER.info("Using cloud GPIO script: %s", CLOUD_GPIO_SCRIPT)
+            return CLOUD_GPIO_SCRIPT
         LOGGER.warning("Cloud script unavailable, falling back to local GPIO script.")
 
+    if CLOUD_GPIO_SCRIPT.exists():
+        LOGGER.info("Using previously downloaded cloud GPIO script: %s", CLOUD_GPIO_SCRIPT)
+        return CLOUD_GPIO_SCRIPT
+
     if LOCAL_GPIO_SCRIPT.exists():
         LOGGER.info("Using local fallback GPIO script: %s", LOCAL_GPIO_SCRIPT)
         return LOCAL_GPIO_SCRIPT
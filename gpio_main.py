@@ -7,8 +7,10 @@ Replace this file with production relay/sensor logic as needed.
 from __future__ import annotations
 
 import logging
+import os
+import signal
 import sys
-import time
+import threading
 
 
 logging.basicConfig(
@@ -17,12 +19,27 @@ logging.basicConfig(
     stream=sys.stdout,
 )
 
+HEARTBEAT_SECONDS = float(os.getenv("GPIO_HEARTBEAT_SECONDS", "30"))
+
+_SHUTDOWN = threading.Event()
+
+
+def _handle_signal(signum: int, _frame: object) -> None:
+    logging.info("Received signal %s, shutting down.", signum)
+    _SHUTDOWN.set()
+
 
 def main() -> int:
+    signal.signal(signal.SIGTERM, _handle_signal)
+    signal.signal(signal.SIGINT, _handle_signal)
+
     logging.info("Local fallback gpio_main.py started.")
-    while True:
+    # Event.wait blocks until the heartbeat interval elapses or a signal
+    # sets the event, so `systemctl stop` returns immediately instead of
+    # waiting out the remainder of a sleep.
+    while not _SHUTDOWN.wait(timeout=HEARTBEAT_SECONDS):
         logging.info("SmartLock heartbeat: GPIO service alive.")
-        time.sleep(30)
+    return 0
 
 
 if __name__ == "__main__":
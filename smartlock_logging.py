@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""
+Shared logging setup for the ELECTRONIC CLIKS SmartLock scripts.
+- Resolves a writable log location (/var/log first, script-local fallback).
+- Builds rotating-file + stdout handlers with the project formatter.
+- Caches everything so repeated calls cost nothing.
+"""
+
+from __future__ import annotations
+
+import functools
+import logging
+from logging.handlers import RotatingFileHandler
+import os
+from pathlib import Path
+import sys
+
+PROJECT_NAME = "electronicclicks"
+SCRIPT_DIR = Path(__file__).resolve().parent
+
+_FORMATTER = logging.Formatter(
+    fmt="%(asctime)s | %(levelname)s | %(name)s | %(message)s",
+    datefmt="%Y-%m-%d %H:%M:%S",
+)
+
+
+@functools.lru_cache(maxsize=None)
+def _resolve_log_file(filename: str) -> Path:
+    preferred = Path("/var/log") / PROJECT_NAME / filename
+    fallback = SCRIPT_DIR / "logs" / filename
+
+    for candidate in (preferred, fallback):
+        try:
+            candidate.parent.mkdir(parents=True, exist_ok=True)
+            # Probe writability with a bare open/close syscall pair; a
+            # buffered text handle would allocate wrappers for nothing.
+            fd = os.open(
+                str(candidate), os.O_WRONLY | os.O_APPEND | os.O_CREAT | os.O_CLOEXEC, 0o644
+            )
+            os.close(fd)
+            return candidate
+        except OSError:
+            continue
+
+    return fallback
+
+
+@functools.lru_cache(maxsize=None)
+def get_logger(name: str, filename: str, backup_count: int = 5) -> logging.Logger:
+    logger = logging.getLogger(name)
+    logger.setLevel(logging.INFO)
+
+    if logger.handlers:
+        return logger
+
+    log_file = _resolve_log_file(filename)
+
+    file_handler = RotatingFileHandler(
+        log_file, maxBytes=2 * 1024 * 1024, backupCount=backup_count
+    )
+    file_handler.setFormatter(_FORMATTER)
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(_FORMATTER)
+
+    logger.addHandler(file_handler)
+    logger.addHandler(stream_handler)
+    logger.propagate = False
+
+    logger.info("Logger '%s' initialized at %s", name, log_file)
+    return logger
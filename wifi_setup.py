@@ -11,18 +11,42 @@ ELECTRONIC CLIKS SmartLock IoT Wi-Fi provisioning utility.
 from __future__ import annotations
 
 import argparse
+import errno
 import html
 import logging
-from logging.handlers import RotatingFileHandler
 import os
 from pathlib import Path
+import re
+import select
+import shlex
 import socket
 import subprocess
 import sys
 import threading
 import time
 
-from flask import Flask, request
+import waitress
+from flask import Flask, Response, request
+
+from smartlock_logging import get_logger
+
+# Talking to NetworkManager over D-Bus replaces a 50-200ms nmcli fork/exec
+# with a ~1ms bus round trip. The bindings are optional; every call site
+# falls back to the nmcli subprocess path when they are unavailable.
+try:
+    import sdbus
+    from sdbus_block.networkmanager import (
+        ActiveConnection,
+        NetworkDeviceGeneric,
+        NetworkManager as NMDBus,
+    )
+
+    sdbus.set_default_bus(sdbus.sd_bus_open_system())
+    _NM_DBUS_AVAILABLE = True
+except Exception:  # pylint: disable=broad-except
+    _NM_DBUS_AVAILABLE = False
+
+NM_DEVICE_TYPE_WIFI = 2
 
 PROJECT_NAME = "electronicclicks"
 HOTSPOT_SSID = "SmartLock-Setup"
@@ -30,71 +54,109 @@ HOTSPOT_PASSWORD = "electroniccliks"
 WPA_SUPPLICANT_FILE = Path("/etc/wpa_supplicant/wpa_supplicant.conf")
 
 app = Flask(__name__)
-LOGGER = logging.getLogger(PROJECT_NAME + "_wifi")
+LOGGER = get_logger(PROJECT_NAME + "_wifi", "wifi_setup.log", backup_count=3)
 WIFI_INTERFACE = ""
+WIFI_INTERFACE_STATE = ""
 HOTSPOT_CONNECTION_NAME = ""
 
 
-def _resolve_log_file() -> Path:
-    preferred = Path("/var/log") / PROJECT_NAME / "wifi_setup.log"
-    fallback = Path(__file__).resolve().parent / "logs" / "wifi_setup.log"
-
-    for candidate in (preferred, fallback):
-        try:
-            candidate.parent.mkdir(parents=True, exist_ok=True)
-            with open(candidate, "a", encoding="utf-8"):
-                pass
-            return candidate
-        except OSError:
-            continue
-
-    return fallback
-
-
-def setup_logger() -> None:
-    LOGGER.setLevel(logging.INFO)
-    if LOGGER.handlers:
-        return
-
-    formatter = logging.Formatter(
-        fmt="%(asctime)s | %(levelname)s | %(name)s | %(message)s",
-        datefmt="%Y-%m-%d %H:%M:%S",
+def run_command(
+    command: list[str], check: bool = True, capture: bool = True
+) -> subprocess.CompletedProcess[str]:
+    if LOGGER.isEnabledFor(logging.INFO):
+        LOGGER.info("Executing command: %s", shlex.join(command))
+    if capture:
+        return subprocess.run(command, check=check, text=True, capture_output=True)
+    # Fire-and-forget callers discard the output; DEVNULL lets the kernel
+    # drop it without buffering bytes through pipes into Python.
+    return subprocess.run(
+        command,
+        check=check,
+        text=True,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
     )
 
-    file_handler = RotatingFileHandler(_resolve_log_file(), maxBytes=2 * 1024 * 1024, backupCount=3)
-    file_handler.setFormatter(formatter)
-
-    stream_handler = logging.StreamHandler(sys.stdout)
-    stream_handler.setFormatter(formatter)
-
-    LOGGER.addHandler(file_handler)
-    LOGGER.addHandler(stream_handler)
-    LOGGER.propagate = False
-
-
-def run_command(command: list[str], check: bool = True) -> subprocess.CompletedProcess[str]:
-    LOGGER.info("Executing command: %s", " ".join(command))
-    return subprocess.run(command, check=check, text=True, capture_output=True)
-
 
 def is_internet_connected() -> bool:
+    # Non-blocking connect with a select-bounded wait: a blocking connect can
+    # stall far past its nominal timeout on flaky networks. The probe target
+    # is a literal IP, so no DNS lookup is involved.
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     try:
-        with socket.create_connection(("1.1.1.1", 53), timeout=3):
+        sock.setblocking(False)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        error = sock.connect_ex(("1.1.1.1", 53))
+        if error == 0:
             return True
+        if error not in (errno.EINPROGRESS, errno.EWOULDBLOCK):
+            return False
+        _, writable, _ = select.select([], [sock], [], 1.5)
+        if not writable:
+            return False
+        return sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0
     except OSError:
         return False
+    finally:
+        sock.close()
+
+
+def _detect_wifi_interface_dbus() -> tuple[str, str]:
+    manager = NMDBus()
+    for device_path in manager.get_devices():
+        device = NetworkDeviceGeneric(device_path)
+        if device.device_type == NM_DEVICE_TYPE_WIFI and device.interface:
+            return device.interface, "managed" if device.managed else "unmanaged"
+    return "", ""
+
+
+def _get_active_connection_dbus(device: str) -> str:
+    manager = NMDBus()
+    for connection_path in manager.active_connections:
+        active = ActiveConnection(connection_path)
+        for device_path in active.devices:
+            if NetworkDeviceGeneric(device_path).interface == device:
+                return active.id
+    return ""
+
+
+def _deactivate_connection_dbus(identifier: str) -> bool:
+    manager = NMDBus()
+    for connection_path in manager.active_connections:
+        active = ActiveConnection(connection_path)
+        if identifier in (active.uuid, active.id):
+            manager.deactivate_connection(connection_path)
+            return True
+    return False
+
+
+def detect_wifi_interface() -> tuple[str, str]:
+    """Return (device, state) for the first Wi-Fi interface, or ("", "").
 
+    STATE comes back in the same nmcli call so callers can tell whether the
+    device is already managed without a second subprocess.
+    """
+    if _NM_DBUS_AVAILABLE:
+        try:
+            return _detect_wifi_interface_dbus()
+        except Exception as exc:  # pylint: disable=broad-except
+            LOGGER.warning("NetworkManager D-Bus query failed, using nmcli: %s", exc)
 
-def detect_wifi_interface() -> str:
-    result = run_command(["nmcli", "-t", "-f", "DEVICE,TYPE", "device", "status"])
+    result = run_command(["nmcli", "-t", "-f", "DEVICE,TYPE,STATE", "device", "status"])
     for line in result.stdout.splitlines():
         parts = line.split(":")
-        if len(parts) >= 2 and parts[1] == "wifi" and parts[0]:
-            return parts[0]
-    return ""
+        if len(parts) >= 3 and parts[1] == "wifi" and parts[0]:
+            return parts[0], parts[2]
+    return "", ""
 
 
 def get_active_connection_for_device(device: str) -> str:
+    if _NM_DBUS_AVAILABLE:
+        try:
+            return _get_active_connection_dbus(device)
+        except Exception as exc:  # pylint: disable=broad-except
+            LOGGER.warning("NetworkManager D-Bus query failed, using nmcli: %s", exc)
+
     result = run_command(["nmcli", "-t", "-f", "NAME,DEVICE", "connection", "show", "--active"])
     for line in result.stdout.splitlines():
         parts = line.split(":")
@@ -103,11 +165,19 @@ def get_active_connection_for_device(device: str) -> str:
     return ""
 
 
+_HOTSPOT_ACTIVATED_PATTERN = re.compile(r"successfully activated with '([0-9a-f-]+)'")
+
+
 def start_hotspot() -> None:
     global HOTSPOT_CONNECTION_NAME
 
-    run_command(["nmcli", "device", "set", WIFI_INTERFACE, "managed", "yes"], check=False)
-    run_command(
+    if WIFI_INTERFACE_STATE == "unmanaged":
+        run_command(
+            ["nmcli", "device", "set", WIFI_INTERFACE, "managed", "yes"],
+            check=False,
+            capture=False,
+        )
+    result = run_command(
         [
             "nmcli",
             "device",
@@ -121,46 +191,109 @@ def start_hotspot() -> None:
             HOTSPOT_PASSWORD,
         ]
     )
-    HOTSPOT_CONNECTION_NAME = get_active_connection_for_device(WIFI_INTERFACE) or "Hotspot"
+    # nmcli reports the new connection's UUID on stdout; parsing it avoids a
+    # follow-up "connection show --active" lookup.
+    match = _HOTSPOT_ACTIVATED_PATTERN.search(result.stdout)
+    if match:
+        HOTSPOT_CONNECTION_NAME = match.group(1)
+    else:
+        HOTSPOT_CONNECTION_NAME = get_active_connection_for_device(WIFI_INTERFACE) or "Hotspot"
     LOGGER.info("Hotspot '%s' started on %s", HOTSPOT_SSID, WIFI_INTERFACE)
 
 
+def _start_hotspot_or_exit() -> None:
+    """Thread target for the backgrounded hotspot bringup.
+
+    A bare thread would dump a CalledProcessError to stderr and leave the
+    portal serving with no hotspot to join; log the failure and exit the
+    process nonzero instead so systemd restarts the provisioning cycle.
+    """
+    try:
+        start_hotspot()
+    except Exception as exc:  # pylint: disable=broad-except
+        LOGGER.exception("Hotspot bringup failed: %s", exc)
+        os._exit(1)
+
+
 def stop_hotspot() -> None:
-    if HOTSPOT_CONNECTION_NAME:
-        run_command(["nmcli", "connection", "down", HOTSPOT_CONNECTION_NAME], check=False)
-        LOGGER.info("Hotspot connection '%s' stopped.", HOTSPOT_CONNECTION_NAME)
+    if not HOTSPOT_CONNECTION_NAME:
+        return
+
+    if _NM_DBUS_AVAILABLE:
+        try:
+            if _deactivate_connection_dbus(HOTSPOT_CONNECTION_NAME):
+                LOGGER.info("Hotspot connection '%s' stopped.", HOTSPOT_CONNECTION_NAME)
+                return
+        except Exception as exc:  # pylint: disable=broad-except
+            LOGGER.warning("NetworkManager D-Bus deactivate failed, using nmcli: %s", exc)
+
+    run_command(
+        ["nmcli", "connection", "down", HOTSPOT_CONNECTION_NAME], check=False, capture=False
+    )
+    LOGGER.info("Hotspot connection '%s' stopped.", HOTSPOT_CONNECTION_NAME)
 
 
 def escape_wpa(value: str) -> str:
     return value.replace("\\", "\\\\").replace('"', '\\"')
 
 
-def write_wifi_credentials(ssid: str, password: str) -> None:
-    network_block = (
-        "\nnetwork={\n"
-        f'    ssid="{escape_wpa(ssid)}"\n'
-        f'    psk="{escape_wpa(password)}"\n'
-        "    key_mgmt=WPA-PSK\n"
-        "}\n"
-    )
+_WPA_SSID_PATTERN = re.compile(r'ssid="((?:\\.|[^"\\])*)"')
+_WPA_CACHE: dict[str, object] = {"mtime": -1.0, "ssids": set()}
+# Serializes cache access and the check-then-append in
+# write_wifi_credentials; waitress runs handlers on multiple threads.
+_WPA_LOCK = threading.Lock()
 
-    existing = ""
-    if WPA_SUPPLICANT_FILE.exists():
-        existing = WPA_SUPPLICANT_FILE.read_text(encoding="utf-8", errors="ignore")
 
-    if f'ssid="{escape_wpa(ssid)}"' in existing:
-        LOGGER.info("SSID already present in wpa_supplicant. Skipping file append.")
-        return
+def _existing_ssids() -> set[str]:
+    """Return the (escaped) SSIDs already in wpa_supplicant.conf.
 
-    WPA_SUPPLICANT_FILE.parent.mkdir(parents=True, exist_ok=True)
-    with open(WPA_SUPPLICANT_FILE, "a", encoding="utf-8") as file_handle:
-        file_handle.write(network_block)
+    The parsed set is cached and only refreshed when the file's mtime
+    changes, so repeated POSTs (e.g. a user retrying a typo) do not reread
+    and rescan the whole file each time. Callers must hold _WPA_LOCK.
+    """
+    try:
+        mtime = WPA_SUPPLICANT_FILE.stat().st_mtime
+    except OSError:
+        return set()
+
+    if mtime != _WPA_CACHE["mtime"]:
+        text = WPA_SUPPLICANT_FILE.read_text(encoding="utf-8", errors="ignore")
+        _WPA_CACHE["ssids"] = set(_WPA_SSID_PATTERN.findall(text))
+        _WPA_CACHE["mtime"] = mtime
+
+    return _WPA_CACHE["ssids"]  # type: ignore[return-value]
+
+
+def write_wifi_credentials(ssid: str, password: str) -> None:
+    escaped_ssid = escape_wpa(ssid)
+    with _WPA_LOCK:
+        if escaped_ssid in _existing_ssids():
+            LOGGER.info("SSID already present in wpa_supplicant. Skipping file append.")
+            return
+
+        network_block = (
+            "\nnetwork={\n"
+            f'    ssid="{escaped_ssid}"\n'
+            f'    psk="{escape_wpa(password)}"\n'
+            "    key_mgmt=WPA-PSK\n"
+            "}\n"
+        )
+
+        WPA_SUPPLICANT_FILE.parent.mkdir(parents=True, exist_ok=True)
+        with open(WPA_SUPPLICANT_FILE, "a", encoding="utf-8") as file_handle:
+            file_handle.write(network_block)
+
+        _WPA_CACHE["ssids"].add(escaped_ssid)  # type: ignore[union-attr]
+        try:
+            _WPA_CACHE["mtime"] = WPA_SUPPLICANT_FILE.stat().st_mtime
+        except OSError:
+            _WPA_CACHE["mtime"] = -1.0
 
     LOGGER.info("Wi-Fi credentials appended to %s", WPA_SUPPLICANT_FILE)
 
 
 def connect_to_wifi(ssid: str, password: str) -> None:
-    run_command(["nmcli", "connection", "delete", ssid], check=False)
+    run_command(["nmcli", "connection", "delete", ssid], check=False, capture=False)
     run_command(
         ["nmcli", "device", "wifi", "connect", ssid, "password", password, "ifname", WIFI_INTERFACE]
     )
@@ -179,7 +312,7 @@ def schedule_shutdown() -> None:
 
 
 @app.route("/", methods=["GET", "POST"])
-def portal() -> str:
+def portal() -> str | Response:
     if request.method == "POST":
         ssid = (request.form.get("ssid") or "").strip()
         password = (request.form.get("password") or "").strip()
@@ -196,7 +329,9 @@ def portal() -> str:
             LOGGER.exception("Wi-Fi provisioning failed: %s", exc)
             return render_form("Connection failed. Please verify credentials and retry.", is_error=True)
 
-    return render_form()
+    # Captive-portal detectors hammer "/" with plain GETs; serve the
+    # pre-rendered form without re-running the template formatting.
+    return Response(_FORM_EMPTY_BYTES, mimetype="text/html")
 
 
 def render_form(message: str = "", is_error: bool = False) -> str:
@@ -238,30 +373,49 @@ def render_form(message: str = "", is_error: bool = False) -> str:
 """
 
 
+# Rendered once at import; the no-message GET is by far the hottest path.
+_FORM_EMPTY_BYTES = render_form().encode("utf-8")
+
+
 def main() -> int:
-    global WIFI_INTERFACE
+    global WIFI_INTERFACE, WIFI_INTERFACE_STATE
 
-    setup_logger()
     LOGGER.info("=== ELECTRONIC CLIKS Wi-Fi setup start ===")
 
     if is_internet_connected():
         LOGGER.info("Internet already connected. Wi-Fi provisioning skipped.")
         return 0
 
-    WIFI_INTERFACE = detect_wifi_interface()
+    WIFI_INTERFACE, WIFI_INTERFACE_STATE = detect_wifi_interface()
     if not WIFI_INTERFACE:
         LOGGER.error("No Wi-Fi interface detected. Ensure NetworkManager is installed and enabled.")
         return 1
 
-    start_hotspot()
-
     parser = argparse.ArgumentParser(description="SmartLock Wi-Fi provisioning portal")
     parser.add_argument("--host", default="0.0.0.0")
     parser.add_argument("--port", type=int, default=80)
     args = parser.parse_args()
 
+    # Bind the portal socket before the slow nmcli work so a client that
+    # connects while hostapd/dnsmasq are still warming up gets queued rather
+    # than refused; the hotspot then comes up on a thread in parallel.
+    listen_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listen_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listen_sock.bind((args.host, args.port))
+    listen_sock.listen(16)
+
+    threading.Thread(target=_start_hotspot_or_exit, daemon=True).start()
+
     LOGGER.info("Portal started at http://%s:%s", args.host, args.port)
-    app.run(host=args.host, port=args.port, debug=False)
+    # Bounded worker pool and connection cap keep a burst of captive-portal
+    # probes from exhausting memory on constrained Pi hardware.
+    waitress.serve(
+        app,
+        sockets=[listen_sock],
+        threads=4,
+        connection_limit=16,
+        channel_timeout=20,
+    )
     return 0
 
 